@@ -1,10 +1,20 @@
 # app/main.py
 from fastapi import FastAPI, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from transformers import pipeline
+from fastapi.responses import Response
+from transformers import AutoImageProcessor, AutoModelForImageClassification, pipeline
 from PIL import Image
-from typing import List, Dict, Any
-import io
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+import asyncio
+import logging
+import os
+import re
+import sys
+import numpy as np
+import orjson
+import torch
 
 app = FastAPI()
 
@@ -17,34 +27,124 @@ app.add_middleware(
 )
 
 # ---------- Models ----------
+# FP16 on GPU when available (half the weight bytes, Tensor Core GEMMs); FP32 on CPU
+DEVICE = 0 if torch.cuda.is_available() else -1
+DTYPE = torch.float16 if DEVICE >= 0 else torch.float32
+
+# Inference only: no autograd, and allow TF32 matmuls on Ampere+ GPUs.
+# Grad mode is thread-local, so the worker-thread forwards also wrap themselves in inference_mode().
+torch.set_grad_enabled(False)
+torch.set_float32_matmul_precision("high")
+
 # Text sentiment (returns POSITIVE / NEGATIVE, sometimes NEUTRAL)
-sentiment_pipe = pipeline("sentiment-analysis")
+sentiment_pipe = pipeline("sentiment-analysis", device=DEVICE, torch_dtype=DTYPE)
+if DEVICE < 0:
+    # CPU: int8 dynamic quantization of the Linear layers (weights quantized once,
+    # activation scales computed per call), so no calibration or retraining needed
+    sentiment_pipe.model = torch.ao.quantization.quantize_dynamic(
+        sentiment_pipe.model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+def classify_texts(texts: List[str]) -> List[Dict[str, Any]]:
+    with torch.inference_mode():
+        return sentiment_pipe(texts, batch_size=len(texts), truncation=True)
 
-# Image emotion classification (returns list of emotions with scores)
+# Image emotion classification: processor + model called directly (no pipeline wrapper),
+# returns one probability row per image in the model's label order.
 # Labels often include: Angry, Disgust, Fear, Happy, Neutral, Sad, Surprise
-emotion_pipe = pipeline(
-    "image-classification",
-    model="dima806/facial_emotions_image_detection"
-)
+EMOTION_MODEL = "dima806/facial_emotions_image_detection"
+TORCH_DEVICE = torch.device("cuda", DEVICE) if DEVICE >= 0 else torch.device("cpu")
+
+# On CPU, prefer an ONNX Runtime export of the emotion model if one is present (see README):
+# graph fusion + MLAS kernels beat eager PyTorch for this small ViT.
+ONNX_DIR = os.getenv("EMOTION_ONNX_DIR", "onnx_model")
+
+def load_emotion_model():
+    if DEVICE < 0 and os.path.isdir(ONNX_DIR):
+        try:
+            from optimum.onnxruntime import ORTModelForImageClassification
+        except ImportError:
+            pass
+        else:
+            return ORTModelForImageClassification.from_pretrained(ONNX_DIR, provider="CPUExecutionProvider")
+    model = AutoModelForImageClassification.from_pretrained(EMOTION_MODEL, torch_dtype=DTYPE)
+    # channels_last lets oneDNN (AVX-512/AMX) and cuDNN use their NHWC kernels for the patch-embedding conv
+    return model.eval().to(TORCH_DEVICE, memory_format=torch.channels_last)
+
+emotion_processor = AutoImageProcessor.from_pretrained(EMOTION_MODEL)
+emotion_model = load_emotion_model()
+
+# Compile the PyTorch forward with Inductor (fused matmul/layernorm/GELU kernels).
+# Graphs are specialized to static shapes, so batches are padded up to a power of two:
+# at most a handful of compiled variants, all built during startup warmup.
+# Default mode rather than "reduce-overhead": forwards run on pooled worker threads,
+# which CUDA graph replay does not support.
+IS_TORCH = isinstance(emotion_model, torch.nn.Module)
+COMPILED = os.getenv("EMOTION_COMPILE", "1") == "1" and IS_TORCH
+# NHWC inputs to match the channels_last torch model; ONNX Runtime wants contiguous NCHW
+INPUT_FORMAT = torch.channels_last if IS_TORCH else torch.contiguous_format
+if COMPILED:
+    emotion_model = torch.compile(emotion_model, fullgraph=True, dynamic=False)
+
+def classify_images(imgs: List[np.ndarray]) -> np.ndarray:
+    n = len(imgs)
+    pixel_values = emotion_processor(images=imgs, return_tensors="pt")["pixel_values"]
+    if COMPILED:
+        pad = (1 << (n - 1).bit_length()) - n
+        if pad:
+            pixel_values = torch.cat([pixel_values, pixel_values.new_zeros((pad, *pixel_values.shape[1:]))])
+    pixel_values = pixel_values.to(TORCH_DEVICE, DTYPE, memory_format=INPUT_FORMAT)
+    with torch.inference_mode():
+        logits = emotion_model(pixel_values=pixel_values).logits
+    return logits[:n].float().softmax(-1).cpu().numpy()
+
+# let cuDNN pick the fastest kernels for our fixed input shapes
+torch.backends.cudnn.benchmark = True
 
 # ---------- Helpers ----------
-# Normalize image labels to lowercase keywords we use
+# Normalize image labels to lowercase keywords we use (model labels already match PLAYLISTS keys).
+# Interned so LABELS are the same objects as the playlist keys: the per-request
+# _PLAYLIST_JSON lookup in mood_response then matches by identity, not string compare.
 def normalize_label(label: str) -> str:
-    l = label.strip().lower()
-    aliases = {
-        "angry": "angry",
-        "disgust": "disgust",
-        "fear": "fear",
-        "happy": "happy",
-        "neutral": "neutral",
-        "sad": "sad",
-        "surprise": "surprise",
-    }
-    return aliases.get(l, l)
+    return sys.intern(label.lower())
+
+# Image model label order (columns of classify_images), normalized to PLAYLISTS keys
+LABELS = tuple(
+    normalize_label(emotion_model.config.id2label[i]) for i in range(emotion_model.config.num_labels)
+)
+
+# Image decoding is CPU-bound and both decoders release the GIL while decompressing,
+# so frames are decoded in parallel on one shared pool.
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# JPEG frames (what the frontend sends) decode straight to an RGB array with libjpeg-turbo
+# when PyTurboJPEG is installed; anything else goes through Pillow.
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _TJ: Optional["TurboJPEG"] = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _TJ = None
+
+def decode_upload(file: UploadFile) -> np.ndarray:
+    # returns an HxWx3 uint8 RGB array; reads the upload's spooled file directly
+    # (no bytes -> BytesIO copy), so it must run on EXECUTOR, not the event loop
+    src = file.file
+    src.seek(0)
+    if _TJ is not None:
+        is_jpeg = src.read(2) == b"\xff\xd8"
+        src.seek(0)
+        if is_jpeg:
+            try:
+                return _TJ.decode(src.read(), pixel_format=TJPF_RGB)
+            except OSError:
+                # e.g. CMYK/YCCK JPEGs libjpeg-turbo can't emit as RGB; Pillow handles them
+                src.seek(0)
+    with Image.open(src) as img:
+        return np.asarray(img.convert("RGB"))
 
 # (NEW) Rich playlists: per emotion we include variety buckets (energetic/chill/karoke/desi/gaming/study)
 # You can add "thumb" if you want to show a cover image in the UI. (Front-end will handle missing.)
-PLAYLISTS: Dict[str, List[Dict[str, str]]] = {
+_PLAYLISTS: Dict[str, List[Dict[str, str]]] = {
     # Core moods
     "happy": [
         # Energetic / Party
@@ -155,47 +255,154 @@ PLAYLISTS: Dict[str, List[Dict[str, str]]] = {
     ],
 }
 
-def pick_playlist(mood: str) -> List[Dict[str, str]]:
-    m = mood.lower()
-    # If we have direct mood list, use it; else fallback to neutral.
-    return PLAYLISTS.get(m, PLAYLISTS["neutral"])
+# Read-only view with interned keys (lookups with interned moods, e.g. LABELS, compare by identity)
+# and tuple values, so the table is never mutated after import.
+PLAYLISTS: Mapping[str, Tuple[Dict[str, str], ...]] = MappingProxyType(
+    {sys.intern(k): tuple(v) for k, v in _PLAYLISTS.items()}
+)
 
-def probs_to_dict(items: List[Dict[str, Any]]) -> Dict[str, float]:
-    # items like [{'label': 'Happy', 'score': 0.92}, ...]
-    out: Dict[str, float] = {}
-    for it in items:
-        out[normalize_label(it["label"])] = float(it["score"])
-    return out
+# Playlists never change, so their JSON is encoded once; responses splice it in as raw bytes.
+_PLAYLIST_JSON: Dict[str, bytes] = {mood: orjson.dumps(lst) for mood, lst in PLAYLISTS.items()}
+_NEUTRAL_JSON = _PLAYLIST_JSON["neutral"]  # unknown moods fall back to neutral
+
+def mood_response(mood: str, confidence: float, probs: Dict[str, float]) -> Response:
+    body = b"".join((
+        b'{"mood":', orjson.dumps(mood),
+        b',"confidence":', orjson.dumps(confidence),
+        b',"playlist":', _PLAYLIST_JSON.get(mood, _NEUTRAL_JSON),
+        b',"probs":', orjson.dumps(probs),
+        b"}",
+    ))
+    return Response(content=body, media_type="application/json")
+
+# Keyword hints for extended moods, compiled into one alternation so the text is scanned once.
+# The zero-width lookahead tests every position, so overlapping keywords are all found and
+# substring semantics match the old `k in lower` checks (no word boundaries).
+_MOOD_RX = re.compile(
+    r"(?=(?P<romantic>love|crush|romantic|date|hearts)"
+    r"|(?P<calm>calm|peaceful|relax|breathe|meditate)"
+    r"|(?P<study>study|focus|concentrat)"
+    r"|(?P<gaming>game|gaming|valorant|pubg|fortnite)"
+    r"|(?P<anger>angry|mad|rage)"
+    r"|(?P<lonely>lonely|alone))",
+    re.I,
+)
+
+# ---------- Dynamic batching ----------
+# Requests are queued and a single consumer per model runs them as one forward pass,
+# so concurrent callers share a batch instead of each launching their own.
+MAX_BATCH = 32
+MAX_WAIT = 0.005  # seconds to wait for more requests after the first one arrives
+
+class BatchQueue:
+    def __init__(self, run: Callable[[List[Any]], List[Any]]):
+        self.run = run  # list of inputs -> list of outputs, same order
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.consume())
+
+    async def submit(self, item: Any) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, fut))
+        return await fut
+
+    async def consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[Tuple[Any, asyncio.Future]] = [await self.queue.get()]
+            deadline = loop.time() + MAX_WAIT
+            while len(batch) < MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                outputs = await asyncio.to_thread(self.run, [item for item, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    outputs = [e]
+                else:
+                    # retry one at a time so a bad input only fails its own request
+                    outputs = [await self.run_one(item) for item, _ in batch]
+            for (_, fut), out in zip(batch, outputs):
+                if fut.done():
+                    continue
+                if isinstance(out, Exception):
+                    fut.set_exception(out)
+                else:
+                    fut.set_result(out)
+
+    async def run_one(self, item: Any) -> Any:
+        # returns the output, or the exception raised for this item alone
+        try:
+            return (await asyncio.to_thread(self.run, [item]))[0]
+        except Exception as e:
+            return e
+
+sentiment_batcher = BatchQueue(classify_texts)
+emotion_batcher = BatchQueue(lambda imgs: list(classify_images(imgs)))
+
+@app.on_event("startup")
+def warmup():
+    global emotion_model, COMPILED
+    # one dummy forward per model so kernel selection / allocator pools are warm before serving
+    classify_texts(["warmup"])
+    blank = np.zeros((224, 224, 3), dtype=np.uint8)
+    if COMPILED:
+        # build every padded batch size up front instead of on a live request
+        try:
+            for size in (1 << i for i in range(MAX_BATCH.bit_length())):
+                classify_images([blank] * size)
+        except Exception:
+            # Inductor needs a C++ compiler (CPU) / Triton (GPU); without them serve the eager model
+            logging.getLogger(__name__).warning("torch.compile failed, using eager emotion model", exc_info=True)
+            emotion_model = emotion_model._orig_mod
+            COMPILED = False
+    classify_images([blank])
+
+@app.on_event("startup")
+async def start_batchers():
+    sentiment_batcher.start()
+    emotion_batcher.start()
 
 # ---------- Routes ----------
 @app.post("/api/predict/text")
 async def predict_text(payload: Dict[str, str]):
     text = (payload or {}).get("text", "").strip()
     if not text:
-        return {"mood": "neutral", "confidence": 0.0, "playlist": pick_playlist("neutral"), "probs": {"neutral": 1.0}}
+        return mood_response("neutral", 0.0, {"neutral": 1.0})
 
-    r = sentiment_pipe(text)[0]
+    # queued for the batching consumer, which runs inference off the event loop
+    r = await sentiment_batcher.submit(text)
     label = r["label"].lower()
     score = float(r["score"])
 
     # Simple mapping
     # allow extra keyword hints for extended moods (romantic, calm etc.)
-    lower = text.lower()
-    if any(k in lower for k in ["love", "crush", "romantic", "date", "hearts"]):
+    # a single pass collects every hint; precedence below is unchanged
+    hints = {m.lastgroup for m in _MOOD_RX.finditer(text)}
+    if "romantic" in hints:
         mood = "romantic"
-    elif any(k in lower for k in ["calm", "peaceful", "relax", "breathe", "meditate"]):
+    elif "calm" in hints:
         mood = "calm"
-    elif any(k in lower for k in ["study", "focus", "concentrat"]):
+    elif "study" in hints:
         mood = "study"
-    elif any(k in lower for k in ["game", "gaming", "valorant", "pubg", "fortnite"]):
+    elif "gaming" in hints:
         mood = "gaming"
     elif "positive" in label:
         mood = "happy"
     elif "negative" in label:
         # choose sad or angry based on trigger words
-        if any(k in lower for k in ["angry", "mad", "rage"]):
+        if "anger" in hints:
             mood = "angry"
-        elif any(k in lower for k in ["lonely", "alone"]):
+        elif "lonely" in hints:
             mood = "lonely"
         else:
             mood = "sad"
@@ -217,54 +424,29 @@ async def predict_text(payload: Dict[str, str]):
         probs["positive"] = 0.2
         probs["negative"] = 0.2
 
-    return {
-        "mood": mood,
-        "confidence": score,
-        "playlist": pick_playlist(mood),
-        "probs": probs,  # frontend mini-chart
-    }
+    return mood_response(mood, score, probs)  # probs feed the frontend mini-chart
 
 @app.post("/api/predict/image")
 async def predict_image(file: UploadFile = File(...)):
-    img = Image.open(io.BytesIO(await file.read())).convert("RGB")
-    results = emotion_pipe(img, top_k=6)
-    # results: list of dicts [{label, score}...], pick max
-    best = max(results, key=lambda x: x["score"])
-    mood = normalize_label(best["label"])
-    return {
-        "mood": mood,
-        "confidence": float(best["score"]),
-        "playlist": pick_playlist(mood),
-        "probs": probs_to_dict(results),
-    }
+    img = await asyncio.get_running_loop().run_in_executor(EXECUTOR, decode_upload, file)
+    probs = await emotion_batcher.submit(img)
+    best = int(probs.argmax())
+    mood = LABELS[best]
+    return mood_response(mood, float(probs[best]), dict(zip(LABELS, probs.tolist())))
 
 @app.post("/api/predict/images")
 async def predict_images(files: List[UploadFile] = File(...)):
     # vote over multiple frames
-    bag: List[Dict[str, float]] = []
-    for f in files:
-        img = Image.open(io.BytesIO(await f.read())).convert("RGB")
-        results = emotion_pipe(img, top_k=6)
-        bag.append(probs_to_dict(results))
-
-    # average probs
-    avg: Dict[str, float] = {}
-    for d in bag:
-        for k, v in d.items():
-            avg[k] = avg.get(k, 0.0) + v
-    for k in list(avg.keys()):
-        avg[k] /= max(1, len(bag))
+    loop = asyncio.get_running_loop()
+    imgs = await asyncio.gather(*(loop.run_in_executor(EXECUTOR, decode_upload, f) for f in files))
+    # frames go through the batching queue together, so they share a forward pass
+    rows = await asyncio.gather(*(emotion_batcher.submit(img) for img in imgs))
+
+    # average probs: one row per frame
+    avg = np.stack(rows).mean(axis=0)
 
     # pick best mood
-    if avg:
-        mood = max(avg.items(), key=lambda kv: kv[1])[0]
-        conf = avg[mood]
-    else:
-        mood, conf = "neutral", 0.0
-
-    return {
-        "mood": mood,
-        "confidence": float(conf),
-        "playlist": pick_playlist(mood),
-        "probs": avg,
-    }
+    best = int(avg.argmax())
+    mood, conf = LABELS[best], avg[best]
+
+    return mood_response(mood, float(conf), dict(zip(LABELS, avg.tolist())))